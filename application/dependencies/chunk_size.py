@@ -0,0 +1,51 @@
+from nameko.extensions import DependencyProvider
+
+
+class AdaptiveChunkSize(DependencyProvider):
+    def __init__(self):
+        self.tables = dict()
+
+    def setup(self):
+        config = self.container.config
+        self.initial_bytes = int(config.get('COPY_CHUNK_INITIAL_BYTES', 1024 * 1024))
+        self.min_bytes = int(config.get('COPY_CHUNK_MIN_BYTES', 64 * 1024))
+        self.max_bytes = int(config.get('COPY_CHUNK_MAX_BYTES', 64 * 1024 * 1024))
+        self.target_latency = float(config.get('COPY_CHUNK_TARGET_LATENCY', 1.0))
+
+    def stop(self):
+        self.tables.clear()
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    def _clamp(self, n_bytes):
+        return int(max(self.min_bytes, min(self.max_bytes, n_bytes)))
+
+    def get_target_bytes(self, table):
+        state = self.tables.get(table.lower())
+
+        if state is None:
+            return self._clamp(self.initial_bytes)
+
+        return state['target']
+
+    def record(self, table, n_bytes, duration):
+        key = table.lower()
+        target = self.get_target_bytes(table)
+        state = self.tables.setdefault(key, {'target': target, 'best_throughput': 0., 'best_target': target})
+
+        if n_bytes < state['target'] or duration <= 0:
+            return
+
+        throughput = n_bytes / duration
+
+        if throughput >= state['best_throughput']:
+            state['best_throughput'] = throughput
+            state['best_target'] = state['target']
+
+        factor = max(0.5, min(2., self.target_latency / duration))
+
+        if throughput < 0.75 * state['best_throughput'] and state['target'] > state['best_target']:
+            factor = min(factor, (state['best_target'] / state['target']) ** 0.5)
+
+        state['target'] = self._clamp(state['target'] * factor)
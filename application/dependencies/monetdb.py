@@ -1,53 +1,198 @@
+import time
+from logging import getLogger
 from weakref import WeakKeyDictionary
 from queue import Queue
 
 import pymonetdb
 from nameko.extensions import DependencyProvider
 
+_log = getLogger(__name__)
+
+
+class LazyConnection(object):
+
+    def __init__(self, provider, worker_ctx):
+        self._provider = provider
+        self._worker_ctx = worker_ctx
+        self._connection = None
+
+    def __getattr__(self, name):
+        if self._connection is None:
+            self._connection = self._provider._acquire(self._worker_ctx)
+        return getattr(self._connection, name)
+
 
 class MonetDbConnection(DependencyProvider):
 
-    def __init__(self):
+    def __init__(self, role='primary'):
+        self.role = role
         self.connection_pool = None
         self.connections = WeakKeyDictionary()
+        self.checkouts = WeakKeyDictionary()
+        self.pools = dict()
+        self.nodes = list()
+        self.primary_provider = None
+
+    def _get_nodes(self):
+        config = self.container.config
+        nodes = config.get('MONETDB_NODES')
+
+        if not nodes:
+            nodes = [{'host': config['MONETDB_HOST'], 'port': config.get('MONETDB_PORT'), 'role': 'primary'}]
+
+        result = list()
+        for node in nodes:
+            node = dict(node)
+            node.setdefault('role', 'replica')
+            node.setdefault('name', '{}:{}'.format(node['host'], node.get('port') or 50000))
+            node.update({'wait': 0., 'in_use': 0, 'ejected_until': 0.})
+            result.append(node)
+
+        return result
 
-    def _get_connection(self):
-        conn = pymonetdb.connect(hostname=self.container.config['MONETDB_HOST'],
-                                            username=self.container.config['MONETDB_USER'],
-                                            password=self.container.config['MONETDB_PASSWORD'],
-                                            database=self.container.config['MONETDB_DATABASE'],
-                                            autocommit=True)
+    def _get_connection(self, node=None):
+        node = node or self.primary
+        params = dict(hostname=node['host'],
+                      username=node.get('user', self.container.config['MONETDB_USER']),
+                      password=node.get('password', self.container.config['MONETDB_PASSWORD']),
+                      database=node.get('database', self.container.config['MONETDB_DATABASE']),
+                      autocommit=True)
+
+        if node.get('port'):
+            params['port'] = int(node['port'])
+
+        conn = pymonetdb.connect(**params)
 
         return conn
 
     def setup(self):
-        self.maxsize = 10
-        self.connection_pool = Queue(maxsize=self.maxsize)
+        self.maxsize = int(self.container.config.get('MONETDB_POOL_SIZE', 10))
+        self.retry_interval = float(self.container.config.get('MONETDB_NODE_RETRY_INTERVAL', 30))
+        self.nodes = self._get_nodes()
+
+        primaries = [n for n in self.nodes if n['role'] == 'primary']
+        if len(primaries) != 1:
+            raise ValueError('Exactly one primary MonetDB node is required, got {}'.format(len(primaries)))
+
+        self.primary = primaries[0]
+        self.replicas = [n for n in self.nodes if n['role'] == 'replica']
+
+        if self.role == 'primary':
+            served = [self.primary]
+        else:
+            self.primary_provider = self._find_primary_provider()
+            served = self.replicas + ([] if self.primary_provider is not None else [self.primary])
+
+        for node in served:
+            pool = Queue(maxsize=self.maxsize)
+
+            for c in range(self.maxsize):
+                try:
+                    pool.put(self._get_connection(node))
+                except (pymonetdb.exceptions.Error, OSError):
+                    if node is self.primary:
+                        raise
+                    _log.warning('Ejecting MonetDB node {}'.format(node['name']))
+                    node['ejected_until'] = time.time() + self.retry_interval
+                    break
+
+            while not pool.full():
+                pool.put(None)
+
+            self.pools[node['name']] = pool
 
-        for c in range(self.maxsize):
-            self.connection_pool.put(self._get_connection())
+        self.connection_pool = self.pools.get(self.primary['name'])
 
     def stop(self):
-        for c in range(self.maxsize):
-            conn = self.connection_pool.get()
-            del conn
-            self.connection_pool.put(None)
+        for pool in self.pools.values():
+            for c in range(self.maxsize):
+                conn = pool.get()
+                del conn
+                pool.put(None)
 
+        self.pools.clear()
         del self.connection_pool
 
-    def get_dependency(self, worker_ctx):
-        connection = self.connection_pool.get()
+    def _find_primary_provider(self):
+        for dependency in getattr(self.container, 'dependencies', ()):
+            if isinstance(dependency, MonetDbConnection) and dependency.role == 'primary':
+                return dependency
+        return None
+
+    def _pool(self, node):
+        if node is self.primary and self.primary_provider is not None:
+            return self.primary_provider.connection_pool
+        return self.pools[node['name']]
+
+    def _pick_node(self):
+        if self.role == 'primary':
+            return self.primary
+
+        now = time.time()
+        candidates = [n for n in self.replicas if n['ejected_until'] <= now]
+
+        if not candidates:
+            return self.primary
+
+        free = [n for n in candidates if not self.pools[n['name']].empty()]
+
+        if free:
+            return min(free, key=lambda n: n['in_use'])
+
+        return min(candidates, key=lambda n: n['wait'])
+
+    def _checkout(self, node):
+        pool = self._pool(node)
+
+        start = time.time()
+        connection = pool.get()
+        node['wait'] = 0.8 * node['wait'] + 0.2 * (time.time() - start)
 
         try:
-            connection.execute('SELECT 1')
-        except (pymonetdb.exceptions.Error, ConnectionResetError):
-            connection = self._get_connection()
-            pass
+            if connection is None:
+                connection = self._get_connection(node)
+            else:
+                try:
+                    connection.execute('SELECT 1')
+                except (pymonetdb.exceptions.Error, OSError):
+                    connection = self._get_connection(node)
+        except (pymonetdb.exceptions.Error, OSError):
+            pool.put(None)
+            raise
+
+        return connection
+
+    def _acquire(self, worker_ctx):
+        while True:
+            node = self._pick_node()
+
+            try:
+                connection = self._checkout(node)
+                break
+            except (pymonetdb.exceptions.Error, OSError):
+                if node is self.primary:
+                    raise
+                _log.warning('Ejecting MonetDB node {}'.format(node['name']))
+                node['ejected_until'] = time.time() + self.retry_interval
 
-        self.connections[worker_ctx] = connection
+        node['in_use'] += 1
+        self.checkouts[worker_ctx] = (node, connection)
+
+        return connection
+
+    def get_dependency(self, worker_ctx):
+        if self.role == 'primary':
+            self.connections[worker_ctx] = self._acquire(worker_ctx)
+        else:
+            self.connections[worker_ctx] = LazyConnection(self, worker_ctx)
 
         return self.connections[worker_ctx]
 
     def worker_teardown(self, worker_ctx):
-        connection = self.connections.pop(worker_ctx)
-        self.connection_pool.put(connection)
+        self.connections.pop(worker_ctx)
+        checkout = self.checkouts.pop(worker_ctx, None)
+
+        if checkout is not None:
+            node, connection = checkout
+            node['in_use'] -= 1
+            self._pool(node).put(connection)
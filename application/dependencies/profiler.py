@@ -0,0 +1,88 @@
+import re
+import time
+import random
+from collections import deque
+from logging import getLogger
+
+import pymonetdb.exceptions
+from nameko.extensions import DependencyProvider
+
+_log = getLogger(__name__)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_COPY_DATA = re.compile(r"'(?:[^']|'')*'|;")
+
+
+class StatementProfiler(DependencyProvider):
+
+    def __init__(self):
+        self.statements = None
+
+    def setup(self):
+        config = self.container.config
+        self.threshold = float(config.get('SLOW_STATEMENT_THRESHOLD', 1.0))
+        self.capture = config.get('SLOW_STATEMENT_CAPTURE')
+        self.sample_rate = float(config.get('SLOW_STATEMENT_SAMPLE_RATE', 1.0))
+        self.statements = deque(maxlen=int(config.get('SLOW_STATEMENT_BUFFER_SIZE', 100)))
+
+        if self.capture is not None and self.capture.upper() not in ('TRACE', 'EXPLAIN'):
+            raise ValueError('Unknown slow statement capture mode {}'.format(self.capture))
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    @staticmethod
+    def shape(operation):
+        if operation.lstrip().upper().startswith('COPY'):
+            end = next((m.start() for m in _COPY_DATA.finditer(operation) if m.group() == ';'), len(operation))
+            operation = operation[:end]
+
+        return ' '.join(_LITERALS.sub('?', operation).split())[:1000]
+
+    def _can_capture(self, operation):
+        keyword = operation.lstrip().split(None, 1)[0].upper() if operation.strip() else ''
+
+        if self.capture.upper() == 'TRACE':
+            return keyword in ('SELECT', 'WITH')
+
+        return keyword in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+    def _capture(self, connection, operation, params):
+        cursor = connection.cursor()
+        mode = self.capture.upper()
+
+        try:
+            cursor.execute('{} {}'.format(mode, operation), params)
+
+            if mode == 'TRACE':
+                cursor.execute('SELECT TICKS, STMT FROM SYS.TRACELOG()')
+
+            return '\n'.join(' '.join(str(v) for v in r) for r in cursor.fetchall())
+        except (pymonetdb.exceptions.Error, OSError) as e:
+            return 'Capture failed: {}'.format(str(e))
+        finally:
+            cursor.close()
+
+    def record(self, connection, operation, params, duration, rows=None, error=None):
+        if duration < self.threshold:
+            return
+
+        entry = {
+            'shape': self.shape(operation),
+            'params': len(params) if params else 0,
+            'duration': duration,
+            'rows': rows,
+            'error': error,
+            'timestamp': time.time()
+        }
+
+        _log.warning('Slow statement ({:.3f}s, {} rows, {} params{}): {}'.format(
+            duration, rows, entry['params'], ', failed' if error is not None else '', entry['shape']))
+
+        if error is None and self.capture is not None and self._can_capture(operation) and random.random() < self.sample_rate:
+            entry['capture'] = self._capture(connection, operation, params)
+
+        self.statements.append(entry)
+
+    def get_statements(self):
+        return list(self.statements)
@@ -1,13 +1,26 @@
 import logging
 from logging import getLogger
 import time
+import hashlib
+import re
+import textwrap
+from string import Formatter
+import os
+import mmap
+from itertools import islice
+from uuid import uuid4
 from nameko.rpc import rpc
 from nameko.dependency_providers import DependencyProvider
 import pymonetdb
 import pymonetdb.exceptions
+from pymonetdb.sql import monetize
 from bson.json_util import loads
 
 from application.dependencies.monetdb import MonetDbConnection
+from application.dependencies.chunk_size import AdaptiveChunkSize
+from application.dependencies.profiler import StatementProfiler
+from application.services.envelope import is_envelope, iter_records, iter_lines
+from application.services.udf_templates import TEMPLATES
 
 logging.getLogger('pymonetdb').setLevel(logging.ERROR)
 _log = getLogger(__name__)
@@ -26,6 +39,43 @@ class DatastoreService(object):
     name = 'datastore'
     error = ErrorHandler()
     connection = MonetDbConnection()
+    chunk_sizer = AdaptiveChunkSize()
+    profiler = StatementProfiler()
+
+    def _execute(self, cursor, operation, params=None):
+        start = time.time()
+        rows = None
+        error = None
+        try:
+            rows = cursor.execute(operation, params)
+            return rows
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.profiler.record(cursor.connection, operation, params, time.time() - start, rows, error)
+
+    def _connection_execute(self, operation):
+        start = time.time()
+        error = None
+        try:
+            return self.connection.execute(operation)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.profiler.record(self.connection, operation, None, time.time() - start, None, error)
+
+    def _command(self, command, rows=None):
+        start = time.time()
+        error = None
+        try:
+            return self.connection.command(command)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.profiler.record(self.connection, command[1:], None, time.time() - start, rows, error)
 
     def _create_table(self, table_name, meta, is_merge_table=False, query=None, params=None):
         _log.info('Creating table {} table_name'.format(table_name))
@@ -37,30 +87,30 @@ class DatastoreService(object):
         try:
             if query is None:
                 if is_merge_table:
-                    self.connection.execute(
+                    self._connection_execute(
                         'CREATE MERGE TABLE {table} ({columns})'.format(table=table_name, columns=columns))
                 else:
-                    self.connection.execute(
+                    self._connection_execute(
                         'CREATE TABLE {table} ({columns})'.format(table=table_name, columns=columns))
             else:
                 if params is None:
-                    self.connection.execute(
+                    self._connection_execute(
                         'CREATE TABLE {table} AS {query} WITH NO DATA'.format(table=table_name, query=query))
                 else:
-                    cursor.execute(
+                    self._execute(cursor,
                         'CREATE TABLE {table} AS {query} WITH NO DATA'.format(table=table_name, query=query),
                         params)
         finally:
             cursor.close()
 
     def _drop_table(self, table_name):
-        self.connection.execute('DROP TABLE {table}'.format(table=table_name))
+        self._connection_execute('DROP TABLE {table}'.format(table=table_name))
 
     def _check_if_table_exists(self, table_name):
         cursor = self.connection.cursor()
         table_exists = True
         try:
-            cursor.execute('SELECT 1 FROM {} LIMIT 1'.format(table_name))
+            self._execute(cursor, 'SELECT 1 FROM {} LIMIT 1'.format(table_name))
         except pymonetdb.exceptions.OperationalError:
             table_exists = False
             pass
@@ -70,19 +120,65 @@ class DatastoreService(object):
         return table_exists
 
     @staticmethod
-    def _handle_records(records):
+    def _decode_records(records):
         if isinstance(records, str):
             converted = loads(records)
-            if isinstance(converted, list):
+            if is_envelope(converted) or isinstance(converted, list):
                 return converted
             else:
                 return [converted]
         return records
 
+    @staticmethod
+    def _handle_records(records):
+        records = DatastoreService._decode_records(records)
+        if is_envelope(records):
+            return iter_records(records)
+        return records
+
     @staticmethod
     def _chunk_records(l, n):
-        for i in range(0, len(l), n):
-            yield l[i:i+n]
+        it = iter(l)
+        chunk = list(islice(it, n))
+        while chunk:
+            yield chunk
+            chunk = list(islice(it, n))
+
+    @staticmethod
+    def _dedup_key_columns(dedup_key):
+        return [dedup_key] if isinstance(dedup_key, str) else list(dedup_key)
+
+    def _dedup_records(self, records, dedup_key, mapping=None):
+        fields = [k if mapping is None else mapping[k] for k in self._dedup_key_columns(dedup_key)]
+        seen = set()
+
+        for r in records:
+            key = '\x1f'.join('' if r[f] is None else str(r[f]) for f in fields)
+            digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            yield r
+
+    def _insert_missing_keys(self, target_table, staging_table, dedup_key, meta):
+        keys = self._dedup_key_columns(dedup_key)
+        columns = ','.join(m[0] for m in meta)
+        staging_columns = ','.join('s.' + m[0] for m in meta)
+
+        self._connection_execute(
+            'INSERT INTO {table} ({columns}) SELECT {staging_columns} FROM {staging} s '
+            'WHERE {not_null} AND NOT EXISTS (SELECT 1 FROM {table} t WHERE {condition})'.format(
+                table=target_table, columns=columns, staging_columns=staging_columns, staging=staging_table,
+                not_null=' AND '.join('s.{} IS NOT NULL'.format(k) for k in keys),
+                condition=' AND '.join('t.{key} = s.{key}'.format(key=k) for k in keys)))
+
+        self._connection_execute(
+            'INSERT INTO {table} ({columns}) SELECT {staging_columns} FROM {staging} s '
+            'WHERE ({has_null}) AND NOT EXISTS (SELECT 1 FROM {table} t WHERE {condition})'.format(
+                table=target_table, columns=columns, staging_columns=staging_columns, staging=staging_table,
+                has_null=' OR '.join('s.{} IS NULL'.format(k) for k in keys),
+                condition=' AND '.join('(t.{key} = s.{key} OR (t.{key} IS NULL AND s.{key} IS NULL))'.format(key=k)
+                                       for k in keys)))
 
     @rpc
     def add_partition(self, target_table, merge_table, meta):
@@ -92,7 +188,7 @@ class DatastoreService(object):
         if table_exists is False:
             self._create_table(merge_table, meta, True)
 
-        self.connection.execute('ALTER TABLE {} ADD TABLE {}'.format(merge_table, target_table))
+        self._connection_execute('ALTER TABLE {} ADD TABLE {}'.format(merge_table, target_table))
 
     @rpc
     def drop_partition(self, target_table, merge_table):
@@ -101,7 +197,7 @@ class DatastoreService(object):
         partition_exists = self._check_if_table_exists(target_table)
 
         if table_exists is True and partition_exists is True:
-            self.connection.execute('ALTER TABLE {} DROP TABLE {}'.format(merge_table, target_table))
+            self._connection_execute('ALTER TABLE {} DROP TABLE {}'.format(merge_table, target_table))
 
     @rpc
     def insert_from_select(self, target_table, query, params):
@@ -115,9 +211,9 @@ class DatastoreService(object):
 
         try:
             if params is None:
-                cursor.execute('INSERT INTO {table} {query}'.format(table=target_table, query=query))
+                self._execute(cursor, 'INSERT INTO {table} {query}'.format(table=target_table, query=query))
             else:
-                cursor.execute('INSERT INTO {table} {query}'.format(table=target_table, query=query), params)
+                self._execute(cursor, 'INSERT INTO {table} {query}'.format(table=target_table, query=query), params)
         finally:
             cursor.close()
         _log.info('Success !')
@@ -134,7 +230,7 @@ class DatastoreService(object):
 
         try:
             for row in self._handle_records(records):
-                cursor.execute(
+                self._execute(cursor,
                     'INSERT INTO {table} ({columns}) VALUES ({records})'.format(table=target_table,
                                                                                 columns=','.join(k for k in row),
                                                                                 records=','.join(['%s'] * len(row))),
@@ -159,8 +255,9 @@ class DatastoreService(object):
             column = list(records.keys())[0]
 
             try:
-                cursor.execute('DELETE FROM {table} WHERE {column} = %s'.format(table=target_table, column=column),
-                               list(records.values()))
+                self._execute(cursor,
+                              'DELETE FROM {table} WHERE {column} = %s'.format(table=target_table, column=column),
+                              list(records.values()))
             finally:
                 cursor.close()
         _log.info('Success !')
@@ -174,7 +271,7 @@ class DatastoreService(object):
 
         if table_exists:
             try:
-                cursor.execute('DELETE FROM {}'.format(target_table))
+                self._execute(cursor, 'DELETE FROM {}'.format(target_table))
             finally:
                 cursor.close()
         _log.info('Success !')
@@ -189,7 +286,7 @@ class DatastoreService(object):
                 params = list(row.values())
                 params.append(row[update_key])
                 columns = ','.join(k + ' = %s' for k in row)
-                cursor.execute(
+                self._execute(cursor,
                     'UPDATE {table} SET {columns} WHERE {update_key} = %s'.format(table=target_table,
                                                                                   columns=columns,
                                                                                   update_key=update_key)
@@ -210,20 +307,21 @@ class DatastoreService(object):
 
         try:
             for row in self._handle_records(records):
-                n = cursor.execute('SELECT 1 FROM {table} WHERE {upsert_key} = %s'.format(table=target_table,
-                                                                                          upsert_key=upsert_key),
-                                   [row[upsert_key]])
+                n = self._execute(cursor,
+                                  'SELECT 1 FROM {table} WHERE {upsert_key} = %s'.format(table=target_table,
+                                                                                         upsert_key=upsert_key),
+                                  [row[upsert_key]])
                 if n > 0:
                     params = list(row.values())
                     params.append(row[upsert_key])
                     columns = ','.join(k + ' = %s' for k in row)
-                    cursor.execute(
+                    self._execute(cursor,
                         'UPDATE {table} SET {columns} WHERE {upsert_key} = %s'.format(table=target_table,
                                                                                       columns=columns,
                                                                                       upsert_key=upsert_key)
                         , params)
                 else:
-                    cursor.execute(
+                    self._execute(cursor,
                         'INSERT INTO {table} ({columns}) VALUES ({records})'.format(table=target_table,
                                                                                     columns=','.join(
                                                                                         k for k in row),
@@ -234,54 +332,327 @@ class DatastoreService(object):
             cursor.close()
         _log.info('Success !')
 
+    @staticmethod
+    def _serialize_record(record, meta, mapping=None):
+        ordered_record = list()
+        for m in meta:
+            if mapping is None:
+                key = m[0]
+            else:
+                key = mapping[m[0]]
+            ordered_record.append('' if record[key] is None else str(record[key]))
+        return '|'.join(ordered_record)
+
+    def _copy_records(self, target_table, string_records):
+        data = '\n'.join(string_records)
+
+        cmd = 'sCOPY {n} RECORDS INTO {table} FROM STDIN NULL AS \'\';{data}\n'.format(n=len(string_records),
+                                                                                       table=target_table,
+                                                                                       data=data)
+        self._command(cmd, len(string_records))
+
+    def _adaptive_copy_records(self, target_table, serialized_records, copy_table=None):
+        copy_table = copy_table or target_table
+        target_bytes = self.chunk_sizer.get_target_bytes(target_table)
+        string_records = list()
+        n_bytes = 0
+
+        for string_record in serialized_records:
+            string_records.append(string_record)
+            n_bytes += len(string_record) + 1
+
+            if n_bytes >= target_bytes:
+                _log.info('Processing a {} records ({} bytes) chunk'.format(len(string_records), n_bytes))
+                start = time.time()
+                self._copy_records(copy_table, string_records)
+                self.chunk_sizer.record(target_table, n_bytes, time.time() - start)
+
+                target_bytes = self.chunk_sizer.get_target_bytes(target_table)
+                string_records = list()
+                n_bytes = 0
+
+        if string_records:
+            _log.info('Processing a {} records ({} bytes) chunk'.format(len(string_records), n_bytes))
+            self._copy_records(copy_table, string_records)
+
     @rpc
-    def bulk_insert(self, target_table, records, meta, mapping=None, chunk_size=2500):
+    def bulk_insert(self, target_table, records, meta, mapping=None, chunk_size=2500, adaptive=False,
+                    dedup_key=None, dedup_mode='batch'):
         _log.info('Bulk inserting records into {}'.format(target_table))
+        if dedup_key is not None and dedup_mode not in ('batch', 'table'):
+            raise ValueError('Unknown dedup mode {}'.format(dedup_mode))
+
+        records = self._decode_records(records)
+        is_copy = is_envelope(records) and records.get('format') == 'copy'
+
+        if dedup_key is not None and is_copy:
+            raise ValueError('Deduplication is not supported on copy formatted payloads')
+
         table_exists = self._check_if_table_exists(target_table)
         if table_exists is False:
             self._create_table(target_table, meta)
 
-        clean_records = self._handle_records(records)
-
-        for chunk in self._chunk_records(clean_records, chunk_size):
-            _log.info('Processing a {} chunk'.format(str(chunk_size)))
-            string_records = list()
-            n = 0
-            for r in chunk:
-                ordered_record = list()
-                for m in meta:
-                    if mapping is None:
-                        key = m[0]
-                    else:
-                        key = mapping[m[0]]
-                    ordered_record.append('' if r[key] is None else str(r[key]))
-                string_records.append('|'.join(ordered_record))
-                n += 1
-
-            data = '\n'.join(string_records)
-
-            cmd = 'sCOPY {n} RECORDS INTO {table} FROM STDIN NULL AS \'\';{data}\n'.format(n=n, table=target_table,
-                                                                                           data=data)
-            self.connection.command(cmd)
+        if is_copy:
+            serialized_records = iter_lines(records)
+        else:
+            clean_records = self._handle_records(records)
+
+            if dedup_key is not None:
+                clean_records = self._dedup_records(clean_records, dedup_key, mapping)
+
+            serialized_records = (self._serialize_record(r, meta, mapping) for r in clean_records)
+
+        copy_table = target_table
+        if dedup_key is not None and dedup_mode == 'table':
+            copy_table = '{}_STAGING_{}'.format(target_table, uuid4().hex[:12].upper())
+            self._create_table(copy_table, meta)
+
+        try:
+            if adaptive is True:
+                self._adaptive_copy_records(target_table, serialized_records, copy_table)
+            else:
+                for chunk in self._chunk_records(serialized_records, chunk_size):
+                    _log.info('Processing a {} chunk'.format(str(chunk_size)))
+                    self._copy_records(copy_table, chunk)
+
+            if copy_table != target_table:
+                _log.info('Inserting new keys from {} into {}'.format(copy_table, target_table))
+                self._insert_missing_keys(target_table, copy_table, dedup_key, meta)
+        finally:
+            if copy_table != target_table:
+                self._drop_table(copy_table)
         _log.info('Success !')
 
+    @staticmethod
+    def _quote(value):
+        return "'{}'".format(value.replace("'", "''"))
+
+    @staticmethod
+    def _record_pattern(quote):
+        if not quote:
+            return re.compile(rb'(?:\\.|[^\n\\])+', re.DOTALL)
+
+        q = re.escape(quote).encode()
+        field = rb'\\.|[^\n\\' + q + b']|' + q + rb'(?:\\.|[^\\' + q + b'])*' + q + b'|' + q
+        return re.compile(b'(?:' + field + b')+', re.DOTALL)
+
+    @staticmethod
+    def _has_multiline_records(data, quote):
+        if b'\\' in data:
+            return True
+        if not quote:
+            return False
+
+        q = quote.encode()
+        quotes_and_newlines = data.translate(None, bytes(b for b in range(256) if b not in q + b'\n'))
+        return q in quotes_and_newlines.replace(q + q, b'')
+
+    @staticmethod
+    def _iter_mapped_chunks(mapped, skip, limit, chunk_bytes, quote=None):
+        record = DatastoreService._record_pattern(quote)
+        size = len(mapped)
+        pos = 0
+
+        for m in islice(record.finditer(mapped), skip):
+            pos = m.end()
+
+        remaining = limit
+
+        while pos < size and (remaining is None or remaining > 0):
+            end = mapped.find(b'\n', min(pos + chunk_bytes, size) - 1)
+            end = size if end == -1 else end + 1
+
+            data = mapped[pos:end]
+
+            if not DatastoreService._has_multiline_records(data, quote):
+                data = re.sub(rb'\n\n+', b'\n', data).strip(b'\n')
+                n = data.count(b'\n') + 1 if data else 0
+                pos = end
+
+                if remaining is not None and n > remaining:
+                    data = b'\n'.join(data.split(b'\n', remaining)[:remaining])
+                    n = remaining
+            else:
+                start = last_end = None
+                n = 0
+                blank_lines = False
+                for m in record.finditer(mapped, pos):
+                    if start is None:
+                        start = m.start()
+                    elif m.start() != last_end + 1:
+                        blank_lines = True
+                    last_end = m.end()
+                    n += 1
+                    if last_end - start >= chunk_bytes or n == remaining:
+                        pos = last_end
+                        break
+                else:
+                    pos = size
+
+                if n == 0:
+                    data = b''
+                elif blank_lines:
+                    data = b'\n'.join(m.group() for m in record.finditer(mapped, start, last_end))
+                else:
+                    data = mapped[start:last_end]
+
+            if n == 0:
+                continue
+            if remaining is not None:
+                remaining -= n
+
+            yield n, data.decode('utf-8')
+
+    @rpc
+    def bulk_load_file(self, target_table, path, meta=None, delimiter='|', quote='"', null_as='', header=False,
+                       offset=0, limit=None, on_server=True, chunk_bytes=8 * 1024 * 1024):
+        _log.info('Loading file {} into {}'.format(path, target_table))
+        if meta is not None and self._check_if_table_exists(target_table) is False:
+            self._create_table(target_table, meta)
+
+        skip = offset + (1 if header else 0)
+        options = ' USING DELIMITERS {}, {}{} NULL AS {}'.format(self._quote(delimiter), "'\\n'",
+                                                                 ', ' + self._quote(quote) if quote else '',
+                                                                 self._quote(null_as))
+
+        if on_server is True:
+            records = ''
+            if limit is not None:
+                records = '{} OFFSET {} RECORDS '.format(limit, skip + 1) if skip else '{} RECORDS '.format(limit)
+            elif skip:
+                records = 'OFFSET {} '.format(skip + 1)
+
+            self._connection_execute('COPY {records}INTO {table} FROM {path}{options}'.format(records=records,
+                                                                                           table=target_table,
+                                                                                           path=self._quote(path),
+                                                                                           options=options))
+        elif os.path.getsize(path) > 0:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for n, data in self._iter_mapped_chunks(mapped, skip, limit, chunk_bytes, quote):
+                    _log.info('Processing a {} records ({} bytes) chunk'.format(n, len(data)))
+                    self._command('sCOPY {n} RECORDS INTO {table} FROM STDIN{options};{data}\n'.format(
+                        n=n, table=target_table, options=options, data=data), n)
+        _log.info('Success !')
+
+    @staticmethod
+    def _bind_params(operation, params=None):
+        if not params:
+            return operation
+        if isinstance(params, dict):
+            return operation % dict([(k, monetize.convert(v)) for (k, v) in params.items()])
+        return operation % tuple([monetize.convert(p) for p in params])
+
+    @staticmethod
+    def _normalize_sql(text):
+        parts = re.split(r"('(?:[^']|'')*'|\"[^\"]*\")", text)
+        return ''.join(p if i % 2 else re.sub(r'\s+', ' ', p.lower()) for i, p in enumerate(parts)).strip()
+
+    @staticmethod
+    def _definition_hash(definition, is_function=False):
+        text = definition.strip().rstrip(';').strip()
+
+        if is_function and '{' in text and text.endswith('}'):
+            start = text.index('{')
+            body = textwrap.dedent(text[start + 1:-1])
+            body = '\n'.join(l.rstrip() for l in body.splitlines() if l.strip())
+            text = '{} {{\n{}\n}}'.format(DatastoreService._normalize_sql(text[:start]), body)
+        else:
+            text = DatastoreService._normalize_sql(text)
+
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @staticmethod
+    def _split_schema(name):
+        parts = name.split('.')
+        return (parts[0].lower() if len(parts) > 1 else None), parts[-1].lower()
+
+    def _get_catalog_definition(self, query, name):
+        schema, object_name = self._split_schema(name)
+        cursor = self.connection.cursor()
+
+        try:
+            if schema is None:
+                self._execute(cursor, query.format(schema='CURRENT_SCHEMA'), [object_name])
+            else:
+                self._execute(cursor, query.format(schema='%s'), [object_name, schema])
+
+            r = cursor.fetchone()
+
+            return r[0] if r else None
+        finally:
+            cursor.close()
+
+    def _get_view_definition(self, view_name):
+        return self._get_catalog_definition(
+            'SELECT T.QUERY FROM SYS.TABLES T JOIN SYS.SCHEMAS S ON T.SCHEMA_ID = S.ID '
+            'WHERE T.NAME = %s AND S.NAME = {schema} AND T.TYPE = 1 AND T.SYSTEM = FALSE', view_name)
+
+    def _get_function_definition(self, name):
+        return self._get_catalog_definition(
+            'SELECT F.FUNC FROM SYS.FUNCTIONS F JOIN SYS.SCHEMAS S ON F.SCHEMA_ID = S.ID '
+            'WHERE F.NAME = %s AND S.NAME = {schema} AND F.SYSTEM = FALSE', name)
+
+    def _is_up_to_date(self, kind, current, statement):
+        if current is None:
+            return False
+        is_function = kind == 'function'
+        return self._definition_hash(current, is_function) == self._definition_hash(statement, is_function)
+
+    @staticmethod
+    def _drop_statement(kind, name, f_type=None):
+        if kind == 'view':
+            return 'DROP VIEW {}'.format(name)
+        return 'DROP AGGREGATE {}'.format(name) if f_type == 3 else 'DROP FUNCTION {}'.format(name)
+
+    @staticmethod
+    def _sort_definitions(definitions):
+        by_name = dict((d['name'].lower(), d) for d in definitions)
+        ordered = list()
+        visiting = set()
+        visited = set()
+
+        def visit(key):
+            if key in visited:
+                return
+            if key in visiting:
+                raise ValueError('Circular dependency on {}'.format(key))
+            visiting.add(key)
+            for dep in by_name[key].get('depends_on') or []:
+                if dep.lower() in by_name:
+                    visit(dep.lower())
+            visiting.remove(key)
+            visited.add(key)
+            ordered.append(by_name[key])
+
+        for d in definitions:
+            if d['kind'] not in ('view', 'function'):
+                raise ValueError('Unknown definition kind {}'.format(d['kind']))
+            visit(d['name'].lower())
+
+        return ordered
+
     @rpc
     def create_or_replace_view(self, view_name, query, params=None):
         _log.info('Creating view {}'.format(view_name))
+        statement = self._bind_params('CREATE VIEW {} AS {}'.format(view_name, query), params)
+        current = self._get_view_definition(view_name)
+
+        if self._is_up_to_date('view', current, statement):
+            _log.info('View {} is up to date'.format(view_name))
+            return False
+
         cursor = self.connection.cursor()
-        existed = self._check_if_table_exists(view_name)
 
         try:
-            if existed is True:
-                cursor.execute('DROP VIEW {}'.format(view_name))
+            if current is not None:
+                self._execute(cursor, self._drop_statement('view', view_name))
 
-            if params is not None:
-                cursor.execute('CREATE VIEW {} AS {}'.format(view_name, query), params)
-            else:
-                cursor.execute('CREATE VIEW {} AS {}'.format(view_name, query))
+            self._execute(cursor, statement)
         finally:
             cursor.close()
 
+        return True
+
     @rpc
     def check_if_function_exists(self, name):
         cursor = self.connection.cursor()
@@ -289,7 +660,7 @@ class DatastoreService(object):
         exists = False
 
         try:
-            cursor.execute('SELECT COUNT(*) FROM SYS.FUNCTIONS WHERE NAME = %s', [name])
+            self._execute(cursor, 'SELECT COUNT(*) FROM SYS.FUNCTIONS WHERE NAME = %s', [name])
 
             n = cursor.fetchone()[0]
 
@@ -301,29 +672,179 @@ class DatastoreService(object):
         return exists
 
     def get_function_type(self, name):
+        return self._get_catalog_definition(
+            'SELECT F.TYPE FROM SYS.FUNCTIONS F JOIN SYS.SCHEMAS S ON F.SCHEMA_ID = S.ID '
+            'WHERE F.NAME = %s AND S.NAME = {schema} AND F.SYSTEM = FALSE', name)
+
+    @rpc
+    def create_or_replace_python_function(self, name, script):
+        _log.info('Creating python function into {}'.format(name))
+
+        if self._is_up_to_date('function', self._get_function_definition(name), script):
+            _log.info('Function {} is up to date'.format(name))
+            return False
+
         cursor = self.connection.cursor()
 
-        try:
-            cursor.execute('SELECT TYPE FROM SYS.FUNCTIONS WHERE NAME = %s', [name])
+        f_type = self.get_function_type(name)
 
-            r = cursor.fetchone()
+        try:
+            if f_type:
+                self._execute(cursor, self._drop_statement('function', name, f_type))
 
-            return r[0] if r else None
+            self._execute(cursor, script)
         finally:
             cursor.close()
 
+        return True
+
     @rpc
-    def create_or_replace_python_function(self, name, script):
-        _log.info('Creating python function into {}'.format(name))
-        cursor = self.connection.cursor()
+    def apply_definitions(self, definitions):
+        _log.info('Applying {} view and function definitions'.format(len(definitions)))
+        plan = list()
+        changed = set()
+
+        for d in self._sort_definitions(definitions):
+            key = d['name'].lower()
+
+            if d['kind'] == 'view':
+                statement = self._bind_params('CREATE VIEW {} AS {}'.format(d['name'], d['query']), d.get('params'))
+                current = self._get_view_definition(d['name'])
+                f_type = None
+            else:
+                statement = d['script']
+                current = self._get_function_definition(d['name'])
+                f_type = self.get_function_type(d['name'])
 
-        f_type = self.get_function_type(name)
+            depends_on_changed = any(dep.lower() in changed for dep in d.get('depends_on') or [])
+
+            if depends_on_changed or not self._is_up_to_date(d['kind'], current, statement):
+                changed.add(key)
+                plan.append((d, statement, current is not None, f_type))
+
+        if not plan:
+            _log.info('All definitions are up to date')
+            return []
+
+        self.connection.set_autocommit(False)
+        cursor = self.connection.cursor()
 
         try:
-            if f_type:
-                cursor.execute('DROP AGGREGATE {}'.format(name) if f_type == 3\
-                    else 'DROP FUNCTION {}'.format(name))
+            for d, _, exists, f_type in reversed(plan):
+                if exists:
+                    self._execute(cursor, self._drop_statement(d['kind'], d['name'], f_type))
+
+            for _, statement, _, _ in plan:
+                self._execute(cursor, statement)
 
-            cursor.execute(script)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
         finally:
             cursor.close()
+            self.connection.set_autocommit(True)
+
+        _log.info('Success !')
+        return [d['name'] for d, _, _, _ in plan]
+
+    @staticmethod
+    def _python_udf_script(name, args, returns, body, aggregate=False):
+        signature = ', '.join('{} {}'.format(n, t) for n, t in args)
+
+        if not isinstance(returns, str):
+            returns = 'TABLE({})'.format(', '.join('{} {}'.format(n, t) for n, t in returns))
+
+        return 'CREATE {kind} {name}({signature}) RETURNS {returns} LANGUAGE PYTHON {{\n{body}\n}};'.format(
+            kind='AGGREGATE' if aggregate else 'FUNCTION', name=name, signature=signature, returns=returns,
+            body=textwrap.indent(textwrap.dedent(body).strip('\n'), '    '))
+
+    def _time_query(self, query, runs):
+        cursor = self.connection.cursor()
+        timings = list()
+
+        try:
+            for _ in range(runs):
+                start = time.time()
+                self._execute(cursor, query)
+                cursor.fetchall()
+                timings.append(time.time() - start)
+        finally:
+            cursor.close()
+
+        return {'timings': timings, 'min': min(timings), 'mean': sum(timings) / len(timings)}
+
+    def _benchmark_python_udf(self, name, columns, returns, aggregate, table, rows, runs, group=None):
+        sample = 'SELECT {columns} FROM {table} LIMIT {rows}'.format(columns=', '.join(columns), table=table,
+                                                                    rows=int(rows))
+
+        if aggregate:
+            query = 'SELECT {name}({columns}) FROM ({sample}) AS s'
+        elif not isinstance(returns, str):
+            query = 'SELECT COUNT(*) FROM {name}(({sample})) AS s'
+        else:
+            query = 'SELECT COUNT(r) FROM (SELECT {name}({columns}) AS r FROM ({sample}) AS s) AS b'
+
+        benchmark = self._time_query(query.format(name=name, columns=', '.join(columns), sample=sample), runs)
+
+        if aggregate:
+            grouped_sample = 'SELECT {columns}, {group} AS BENCHMARK_GROUP FROM {table} LIMIT {rows}'.format(
+                columns=', '.join(columns), group=group or 'MOD(ROW_NUMBER() OVER (), 100)', table=table,
+                rows=int(rows))
+            benchmark['grouped'] = self._time_query(
+                'SELECT {name}({columns}) FROM ({sample}) AS s GROUP BY BENCHMARK_GROUP'.format(
+                    name=name, columns=', '.join(columns), sample=grouped_sample), runs)
+
+        return benchmark
+
+    @rpc
+    def deploy_python_udf(self, name, args, returns, body=None, template=None, template_params=None,
+                          aggregate=False, benchmark_table=None, benchmark_columns=None, benchmark_rows=100000,
+                          benchmark_runs=3, benchmark_group=None, max_duration=None):
+        _log.info('Deploying python function {}'.format(name))
+        if (body is None) == (template is None):
+            raise ValueError('Exactly one of body or template is required')
+
+        benchmark_runs = int(benchmark_runs)
+        if benchmark_table is not None and benchmark_runs < 1:
+            raise ValueError('At least one benchmark run is required, got {}'.format(benchmark_runs))
+
+        if template is not None:
+            if template not in TEMPLATES:
+                raise ValueError('Unknown python function template {}'.format(template))
+            if not args:
+                raise ValueError('Python function template {} requires at least one argument'.format(template))
+
+            fields = set(f for _, f, _, _ in Formatter().parse(TEMPLATES[template]['body']) if f)
+            missing = sorted(fields - set(template_params or {}) - {'arg'})
+            if missing:
+                raise ValueError('Python function template {} requires parameters {}'.format(template,
+                                                                                         ', '.join(missing)))
+            aggregate = TEMPLATES[template]['aggregate']
+            body = TEMPLATES[template]['body'].format(arg=args[0][0], **(template_params or {}))
+
+        script = self._python_udf_script(name, args, returns, body, aggregate)
+        result = {'name': name, 'script': script, 'changed': self.create_or_replace_python_function(name, script)}
+
+        if benchmark_table is not None:
+            benchmark = self._benchmark_python_udf(name, benchmark_columns or [n for n, _ in args], returns,
+                                                   aggregate, benchmark_table, benchmark_rows, benchmark_runs,
+                                                   benchmark_group)
+            duration = max(benchmark['min'], benchmark['grouped']['min']) if aggregate else benchmark['min']
+            benchmark.update({
+                'table': benchmark_table,
+                'rows': benchmark_rows,
+                'slow': max_duration is not None and duration > max_duration
+            })
+            result['benchmark'] = benchmark
+
+            if benchmark['slow']:
+                _log.warning('Python function {} took {:.3f}s on {} rows of {}'.format(name, duration,
+                                                                                      benchmark_rows,
+                                                                                      benchmark_table))
+
+        return result
+
+    @rpc
+    def get_slow_statements(self):
+        return self.profiler.get_statements()
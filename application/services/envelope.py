@@ -0,0 +1,80 @@
+import base64
+import zlib
+
+from bson.json_util import loads, dumps
+
+_BLOCK_SIZE = 64 * 1024
+
+
+def is_envelope(payload):
+    return isinstance(payload, dict) and payload.get('envelope') == 'zlib'
+
+
+def _iter_chunks(envelope):
+    data = envelope['data']
+    decompressor = zlib.decompressobj()
+
+    for i in range(0, len(data), _BLOCK_SIZE):
+        chunk = decompressor.decompress(base64.b64decode(data[i:i + _BLOCK_SIZE]))
+        if chunk:
+            yield chunk
+
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def iter_lines(envelope):
+    pending = b''
+
+    for chunk in _iter_chunks(envelope):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line.decode('utf-8')
+
+    if pending:
+        yield pending.decode('utf-8')
+
+
+def iter_records(envelope):
+    payload_format = envelope.get('format', 'ndjson')
+
+    if payload_format == 'json':
+        converted = loads(b''.join(_iter_chunks(envelope)).decode('utf-8'))
+        if isinstance(converted, list):
+            for r in converted:
+                yield r
+        else:
+            yield converted
+    elif payload_format == 'ndjson':
+        for line in iter_lines(envelope):
+            if line.strip():
+                yield loads(line)
+    else:
+        raise ValueError('Envelope format {} does not hold records'.format(payload_format))
+
+
+def pack(records, payload_format='ndjson', level=6):
+    compressor = zlib.compressobj(level)
+    parts = list()
+
+    if payload_format == 'ndjson':
+        for r in records:
+            parts.append(compressor.compress(dumps(r).encode('utf-8') + b'\n'))
+    elif payload_format == 'json':
+        parts.append(compressor.compress(dumps(list(records)).encode('utf-8')))
+    elif payload_format == 'copy':
+        for r in records:
+            parts.append(compressor.compress(r.encode('utf-8') + b'\n'))
+    else:
+        raise ValueError('Unknown envelope format {}'.format(payload_format))
+
+    parts.append(compressor.flush())
+
+    return {
+        'envelope': 'zlib',
+        'format': payload_format,
+        'data': base64.b64encode(b''.join(parts)).decode('ascii')
+    }
@@ -0,0 +1,42 @@
+TEMPLATES = {
+    'grouped_sum': {
+        'aggregate': True,
+        'body': '''
+try:
+    groups, inverse = numpy.unique(aggr_group, return_inverse=True)
+    return numpy.bincount(inverse, weights={arg}, minlength=groups.size)
+except NameError:
+    return numpy.sum({arg})
+'''
+    },
+    'grouped_mean': {
+        'aggregate': True,
+        'body': '''
+try:
+    groups, inverse = numpy.unique(aggr_group, return_inverse=True)
+    sums = numpy.bincount(inverse, weights={arg}, minlength=groups.size)
+    return sums / numpy.bincount(inverse, minlength=groups.size)
+except NameError:
+    return numpy.mean({arg})
+'''
+    },
+    'clip': {
+        'aggregate': False,
+        'body': '''
+return numpy.clip({arg}, {low}, {high})
+'''
+    },
+    'scale': {
+        'aggregate': False,
+        'body': '''
+return {arg} * {factor}
+'''
+    },
+    'zscore': {
+        'aggregate': False,
+        'body': '''
+std = numpy.std({arg})
+return ({arg} - numpy.mean({arg})) / (std if std > 0 else 1.)
+'''
+    }
+}
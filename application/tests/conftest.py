@@ -5,6 +5,8 @@ import os
 import pytest
 from nameko.containers import ServiceContainer
 
+from application.tests.fake_mapi import FakeMapiServer
+
 
 @pytest.fixture
 def host(request):
@@ -31,6 +33,25 @@ def port(request):
     return os.getenv('TEST_DB_PORT')
 
 
+@pytest.fixture
+def replica_host(request):
+    return os.getenv('TEST_DB_REPLICA_HOST', os.getenv('TEST_DB_HOST'))
+
+
+@pytest.fixture
+def replica_port(request):
+    return os.getenv('TEST_DB_REPLICA_PORT', os.getenv('TEST_DB_PORT'))
+
+
+@pytest.yield_fixture
+def fake_mapi(request):
+    server = FakeMapiServer().start()
+
+    yield server
+
+    server.stop()
+
+
 @pytest.yield_fixture
 def container_factory():
 
@@ -0,0 +1,196 @@
+import re
+import socket
+import struct
+import hashlib
+import threading
+import time
+
+MAX_PACKAGE_LENGTH = (1024 * 8) - 2
+
+_COPY_STDIN = re.compile(r'^COPY\s+(?:(\d+)\s+(?:OFFSET\s+\d+\s+)?RECORDS\s+)?INTO\s+(\S+)\s+FROM\s+STDIN',
+                         re.IGNORECASE)
+_COPY_DATA = re.compile(r"'(?:[^']|'')*'|;")
+
+
+class FakeMapiServer(object):
+    """MAPI stand-in answering pymonetdb clients with canned results, simulated latency and connection drops."""
+
+    def __init__(self, host='127.0.0.1', port=0, password=None, latency=0., copy_latency=0., drop_after=None,
+                 rows=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.latency = latency
+        self.copy_latency = copy_latency
+        self.drop_after = drop_after
+        self.rows = rows if rows is not None else [(1,)]
+        self.salt = 'fakemapisalt'
+        self.clients = list()
+        self.stats = {'connections': 0, 'statements': 0, 'copies': 0, 'copied_records': 0, 'drops': 0}
+        self.statements = list()
+        self._socket = None
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        for client in list(self.clients):
+            self._close(client)
+
+    def drop_connections(self):
+        for client in list(self.clients):
+            self._reset(client)
+
+    def _serve(self):
+        while self._socket is not None:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+
+            self.clients.append(client)
+            self.stats['connections'] += 1
+
+            thread = threading.Thread(target=self._handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _close(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        try:
+            client.close()
+        except OSError:
+            pass
+
+    def _reset(self, client):
+        self.stats['drops'] += 1
+        try:
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+        self._close(client)
+
+    @staticmethod
+    def _recv(client, n):
+        data = b''
+        while len(data) < n:
+            chunk = client.recv(n - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _getblock(self, client):
+        parts = list()
+        last = 0
+        while not last:
+            flag = struct.unpack('<H', self._recv(client, 2))[0]
+            last = flag & 1
+            parts.append(self._recv(client, flag >> 1))
+        return b''.join(parts).decode('utf-8')
+
+    @staticmethod
+    def _putblock(client, block):
+        data = block.encode('utf-8')
+        pos = 0
+        while True:
+            chunk = data[pos:pos + MAX_PACKAGE_LENGTH]
+            pos += len(chunk)
+            last = 1 if pos >= len(data) and len(chunk) < MAX_PACKAGE_LENGTH else 0
+            client.sendall(struct.pack('<H', (len(chunk) << 1) + last) + chunk)
+            if last:
+                return
+
+    def _check_credentials(self, response):
+        if self.password is None:
+            return True
+
+        pwhash = response.split(':')[2]
+        password = hashlib.sha512(self.password.encode()).hexdigest()
+        return pwhash == '{SHA1}' + hashlib.sha1((password + self.salt).encode()).hexdigest()
+
+    def _handle(self, client):
+        try:
+            self._putblock(client, '{}:mserver:9:SHA1,MD5:LIT:SHA512:'.format(self.salt))
+            if not self._check_credentials(self._getblock(client)):
+                self._putblock(client, '!InvalidCredentialsException:checkCredentials:invalid credentials\n')
+                self._close(client)
+                return
+            self._putblock(client, '')
+
+            served = 0
+            while True:
+                block = self._getblock(client)
+
+                if not block.startswith('s'):
+                    self._putblock(client, '')
+                    continue
+
+                served += 1
+                if self.drop_after is not None and served > self.drop_after:
+                    self._reset(client)
+                    return
+
+                self._putblock(client, self._execute(block[1:]))
+        except (EOFError, OSError):
+            self._close(client)
+
+    def _execute(self, sql):
+        self.stats['statements'] += 1
+        statement = sql.strip()
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        copy = _COPY_STDIN.match(statement)
+        if copy is not None:
+            end = next((m.start() for m in _COPY_DATA.finditer(statement) if m.group() == ';'), len(statement))
+            header, data = statement[:end], statement[end + 1:]
+            n = int(copy.group(1)) if copy.group(1) else len([l for l in data.split('\n') if l])
+            self.statements.append(header)
+            self.stats['copies'] += 1
+            self.stats['copied_records'] += n
+            if self.copy_latency:
+                time.sleep(self.copy_latency * n)
+            return '&2 {} -1\n'.format(n)
+
+        if statement.endswith(';'):
+            statement = statement[:-1].strip()
+        keyword = statement.split(None, 1)[0].upper() if statement else ''
+        self.statements.append(statement)
+
+        if keyword in ('SELECT', 'WITH', 'EXPLAIN', 'TRACE'):
+            return self._result(self.rows)
+        if keyword in ('START', 'COMMIT', 'ROLLBACK'):
+            return '&4 {}\n'.format('f' if keyword == 'START' else 't')
+        if keyword in ('INSERT', 'UPDATE', 'DELETE'):
+            return '&2 1 -1\n'
+        return '&3\n'
+
+    @staticmethod
+    def _result(rows):
+        columns = len(rows[0]) if rows else 1
+        names = ', '.join('c{}'.format(i) for i in range(columns))
+        lines = [
+            '&1 0 {} {} {}'.format(len(rows), columns, len(rows)),
+            '% {} # table_name'.format(', '.join(['sys.fake'] * columns)),
+            '% {} # name'.format(names),
+            '% {} # type'.format(', '.join(['int'] * columns)),
+            '% {} # length'.format(', '.join(['1'] * columns))
+        ]
+        lines.extend('[ {}\t]'.format(',\t'.join(str(v) for v in r)) for r in rows)
+        return '\n'.join(lines) + '\n'
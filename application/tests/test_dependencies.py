@@ -1,5 +1,6 @@
 from weakref import WeakKeyDictionary
 
+import eventlet
 import pytest
 from mock import Mock
 from nameko.testing.services import dummy
@@ -7,6 +8,8 @@ from nameko.containers import WorkerContext
 import pymonetdb
 
 from application.dependencies.monetdb import MonetDbConnection
+from application.dependencies.chunk_size import AdaptiveChunkSize
+from application.dependencies.profiler import StatementProfiler
 
 
 class DummyService(object):
@@ -113,3 +116,197 @@ def test_weakref(connection):
 
     connection.worker_teardown(worker_ctx)
     assert worker_ctx not in connection.connections
+
+
+def test_read_write_routing(container, config, replica_host, replica_port):
+    container.config.update({
+        'MONETDB_POOL_SIZE': 2,
+        'MONETDB_NODES': [
+            {'host': config['MONETDB_HOST'], 'port': config['MONETDB_PORT'], 'role': 'primary', 'name': 'primary'},
+            {'host': '127.0.0.1', 'port': 1, 'role': 'replica', 'name': 'down'},
+            {'host': replica_host, 'port': replica_port, 'role': 'replica', 'name': 'replica'}
+        ]
+    })
+
+    writer = MonetDbConnection().bind(container, 'connection')
+    writer.setup()
+    assert list(writer.pools) == ['primary']
+
+    worker_ctx = Mock(spec=WorkerContext)
+    writer.get_dependency(worker_ctx)
+    assert writer.checkouts[worker_ctx][0]['name'] == 'primary'
+    writer.worker_teardown(worker_ctx)
+
+    reader = MonetDbConnection(role='replica').bind(container, 'read_connection')
+    reader.setup()
+    down = next(n for n in reader.nodes if n['name'] == 'down')
+    assert down['ejected_until'] > 0
+
+    down['ejected_until'] = 0
+    worker_ctx = Mock(spec=WorkerContext)
+    conn = reader.get_dependency(worker_ctx)
+    assert worker_ctx not in reader.checkouts
+    assert isinstance(conn.cursor(), pymonetdb.sql.cursors.Cursor)
+    assert reader.checkouts[worker_ctx][0]['name'] == 'replica'
+    assert down['ejected_until'] > 0
+
+    reader.worker_teardown(worker_ctx)
+    assert reader.checkouts == WeakKeyDictionary()
+
+    for node in reader.replicas:
+        node['ejected_until'] = float('inf')
+    worker_ctx = Mock(spec=WorkerContext)
+    reader.get_dependency(worker_ctx).cursor()
+    assert reader.checkouts[worker_ctx][0]['name'] == 'primary'
+    reader.worker_teardown(worker_ctx)
+
+    worker_ctx = Mock(spec=WorkerContext)
+    reader.get_dependency(worker_ctx)
+    reader.worker_teardown(worker_ctx)
+    assert reader.checkouts == WeakKeyDictionary()
+
+
+def test_replica_shares_primary_pool(container, config):
+    container.config.update({'MONETDB_POOL_SIZE': 2})
+
+    writer = MonetDbConnection().bind(container, 'connection')
+    reader = MonetDbConnection(role='replica').bind(container, 'read_connection')
+    container.dependencies = [writer, reader]
+    writer.setup()
+    reader.setup()
+
+    assert reader.pools == {}
+    assert reader.primary_provider is writer
+
+    worker_ctx = Mock(spec=WorkerContext)
+    writer.get_dependency(worker_ctx)
+    reader.get_dependency(worker_ctx).cursor()
+    assert writer.connection_pool.qsize() == 0
+
+    reader.worker_teardown(worker_ctx)
+    writer.worker_teardown(worker_ctx)
+    assert writer.connection_pool.qsize() == 2
+
+
+@pytest.fixture
+def fake_container(fake_mapi):
+    config = {
+        'MONETDB_USER': 'monetdb',
+        'MONETDB_PASSWORD': 'monetdb',
+        'MONETDB_HOST': fake_mapi.host,
+        'MONETDB_DATABASE': 'fake',
+        'MONETDB_PORT': fake_mapi.port,
+        'MONETDB_POOL_SIZE': 4
+    }
+    return Mock(spec=DummyService, config=config, service_name='dummy_service')
+
+
+def test_get_dependency_recovers_dropped_connections(fake_mapi, fake_container):
+    connection = MonetDbConnection().bind(fake_container, 'connection')
+    connection.setup()
+    assert fake_mapi.stats['connections'] == 4
+
+    fake_mapi.drop_connections()
+
+    worker_ctx = Mock(spec=WorkerContext)
+    conn = connection.get_dependency(worker_ctx)
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1')
+    assert cursor.fetchone()[0] == 1
+    assert fake_mapi.stats['connections'] == 5
+
+    connection.worker_teardown(worker_ctx)
+    connection.stop()
+
+
+def test_concurrent_checkouts(fake_mapi, fake_container):
+    fake_mapi.latency = 0.01
+    connection = MonetDbConnection().bind(fake_container, 'connection')
+    connection.setup()
+
+    def work():
+        worker_ctx = Mock(spec=WorkerContext)
+        conn = connection.get_dependency(worker_ctx)
+        try:
+            conn.execute('SELECT 1')
+        finally:
+            connection.worker_teardown(worker_ctx)
+
+    pool = eventlet.GreenPool(16)
+    for _ in range(64):
+        pool.spawn(work)
+    pool.waitall()
+
+    assert fake_mapi.stats['statements'] == 128
+    assert connection.connection_pool.qsize() == 4
+    assert fake_mapi.stats['connections'] == 4
+
+    connection.stop()
+
+
+def test_adaptive_chunk_size(container):
+    container.config.update({
+        'COPY_CHUNK_INITIAL_BYTES': 1000,
+        'COPY_CHUNK_MIN_BYTES': 100,
+        'COPY_CHUNK_MAX_BYTES': 10000,
+        'COPY_CHUNK_TARGET_LATENCY': 1.0
+    })
+    chunk_sizer = AdaptiveChunkSize().bind(container, 'chunk_sizer')
+    chunk_sizer.setup()
+
+    assert chunk_sizer.get_target_bytes('T') == 1000
+
+    chunk_sizer.record('T', 1000, 0.1)
+    assert chunk_sizer.get_target_bytes('T') == 2000
+
+    chunk_sizer.record('T', 2000, 4.0)
+    assert chunk_sizer.get_target_bytes('T') == 1000
+
+    chunk_sizer.record('T', 10, 0.001)
+    assert chunk_sizer.get_target_bytes('T') == 1000
+
+    for _ in range(10):
+        chunk_sizer.record('T', chunk_sizer.get_target_bytes('T'), 0.01)
+    assert chunk_sizer.get_target_bytes('T') == 10000
+
+    assert chunk_sizer.get_target_bytes('OTHER') == 1000
+
+
+def test_statement_profiler(container, connection):
+    container.config.update({
+        'SLOW_STATEMENT_THRESHOLD': 0.5,
+        'SLOW_STATEMENT_CAPTURE': 'EXPLAIN',
+        'SLOW_STATEMENT_BUFFER_SIZE': 2
+    })
+    profiler = StatementProfiler().bind(container, 'profiler')
+    profiler.setup()
+    connection.setup()
+
+    conn = connection.get_dependency(Mock(spec=WorkerContext))
+
+    profiler.record(conn, 'SELECT 1', None, 0.1, 1)
+    assert profiler.get_statements() == []
+
+    profiler.record(conn, 'SELECT %s, \'a\' WHERE 2 > 1', [1], 1.0, 1)
+    profiler.record(conn, 'COPY 1 RECORDS INTO T FROM STDIN;1|a', None, 1.0, 1)
+    profiler.record(conn, 'DROP TABLE T', None, 1.0)
+
+    statements = profiler.get_statements()
+    assert len(statements) == 2
+    assert statements[0]['shape'] == 'COPY ? RECORDS INTO T FROM STDIN'
+    assert 'capture' not in statements[0]
+    assert statements[1]['shape'] == 'DROP TABLE T'
+
+    profiler.record(conn, 'SELECT %s, \'a\' WHERE 2 > 1', [1], 1.0, 1)
+    statements = profiler.get_statements()
+    assert statements[-1]['shape'] == 'SELECT %s, ? WHERE ? > ?'
+    assert statements[-1]['params'] == 1
+    assert statements[-1]['capture']
+
+    profiler.record(conn, 'SELECT 1', None, 1.0, None, 'timeout')
+    statements = profiler.get_statements()
+    assert statements[-1]['error'] == 'timeout'
+    assert 'capture' not in statements[-1]
+
+    assert StatementProfiler.shape('COPY 2 RECORDS INTO T FROM STDIN USING DELIMITERS \';\', \'\\n\';1;a\n2;b') == \
+        'COPY ? RECORDS INTO T FROM STDIN USING DELIMITERS ?, ?'
@@ -1,9 +1,14 @@
 import pytest
+from mock import Mock
 import pymonetdb
 import pymonetdb.exceptions
 from nameko.testing.services import worker_factory
+from bson.json_util import dumps
 
 from application.services.datastore import DatastoreService
+from application.services.envelope import pack
+from application.dependencies.chunk_size import AdaptiveChunkSize
+from application.dependencies.profiler import StatementProfiler
 
 
 @pytest.fixture
@@ -177,6 +182,149 @@ def test_bulk_insert(connection):
     assert cursor.fetchone()[0] == 4
 
 
+def test_bulk_insert_adaptive(connection):
+    container = Mock(config={'COPY_CHUNK_INITIAL_BYTES': 16, 'COPY_CHUNK_MIN_BYTES': 16})
+    chunk_sizer = AdaptiveChunkSize().bind(container, 'chunk_sizer')
+    chunk_sizer.setup()
+    service = worker_factory(DatastoreService, connection=connection, chunk_sizer=chunk_sizer)
+
+    records = [{'ID': i, 'VALUE': 'v{}'.format(i)} for i in range(100)]
+    meta = [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(5)')]
+
+    service.bulk_insert('NONPART_ADAPTIVE_BULK_TABLE', records, meta, adaptive=True)
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM NONPART_ADAPTIVE_BULK_TABLE')
+    assert cursor.fetchone()[0] == 100
+
+    assert 'nonpart_adaptive_bulk_table' in chunk_sizer.tables
+
+
+def test_bulk_insert_dedup(connection):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    records = [{'id': 1, 'value': 'toto'}, {'id': 2, 'value': 'titi'}, {'id': 1, 'value': 'toto'}]
+    meta = [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(5)')]
+    mapping = {'ID': 'id', 'VALUE': 'value'}
+
+    service.bulk_insert('NONPART_DEDUP_BULK_TABLE', records, meta, mapping, dedup_key='ID')
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM NONPART_DEDUP_BULK_TABLE')
+    assert cursor.fetchone()[0] == 2
+
+    records = [{'id': 2, 'value': 'titi'}, {'id': 3, 'value': 'tutu'}, {'id': 3, 'value': 'tutu'}]
+    service.bulk_insert('NONPART_DEDUP_BULK_TABLE', records, meta, mapping, dedup_key=['ID'], dedup_mode='table')
+
+    cursor.execute('SELECT COUNT(*) FROM NONPART_DEDUP_BULK_TABLE')
+    assert cursor.fetchone()[0] == 3
+
+    cursor.execute('SELECT COUNT(*) FROM SYS.TABLES WHERE NAME LIKE \'nonpart_dedup_bulk_table_staging_%\'')
+    assert cursor.fetchone()[0] == 0
+
+    with pytest.raises(ValueError):
+        service.bulk_insert('NONPART_DEDUP_BULK_TABLE', records, meta, mapping, dedup_key='ID', dedup_mode='wrong')
+
+
+def test_bulk_insert_dedup_null_keys(connection):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    records = [{'ID': None, 'VALUE': 'toto'}, {'ID': None, 'VALUE': 'titi'}, {'ID': 1, 'VALUE': 'tutu'}]
+    meta = [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(5)')]
+
+    service.bulk_insert('NONPART_DEDUP_NULL_TABLE', records, meta, dedup_key='ID')
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM NONPART_DEDUP_NULL_TABLE WHERE ID IS NULL')
+    assert cursor.fetchone()[0] == 1
+
+    service.bulk_insert('NONPART_DEDUP_NULL_TABLE', records, meta, dedup_key='ID', dedup_mode='table')
+
+    cursor.execute('SELECT COUNT(*) FROM NONPART_DEDUP_NULL_TABLE')
+    assert cursor.fetchone()[0] == 2
+
+
+def test_bulk_insert_dedup_serialized_keys(connection):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    records = [{'ID': 1, 'VALUE': 'a'}, {'ID': '1', 'VALUE': 'b'}, {'ID': None, 'VALUE': 'c'}, {'ID': '', 'VALUE': 'd'}]
+    meta = [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(5)')]
+
+    assert [r['VALUE'] for r in service._dedup_records(records, 'ID')] == ['a', 'c']
+
+    service.bulk_insert('NONPART_DEDUP_TYPES_TABLE', records, meta, dedup_key='ID')
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT ID, VALUE FROM NONPART_DEDUP_TYPES_TABLE ORDER BY VALUE')
+    assert cursor.fetchall() == [(1, 'a'), (None, 'c')]
+
+    records = [{'ID': '1', 'VALUE': 'e'}, {'ID': '', 'VALUE': 'f'}, {'ID': 2, 'VALUE': 'g'}]
+    service.bulk_insert('NONPART_DEDUP_TYPES_TABLE', records, meta, dedup_key='ID', dedup_mode='table')
+
+    cursor.execute('SELECT ID, VALUE FROM NONPART_DEDUP_TYPES_TABLE ORDER BY VALUE')
+    assert cursor.fetchall() == [(1, 'a'), (None, 'c'), (2, 'g')]
+
+    with pytest.raises(ValueError):
+        service.bulk_insert('NONPART_DEDUP_COPY_TABLE', pack(['1|a'], 'copy'), meta, dedup_key='ID')
+
+    cursor.execute("SELECT COUNT(*) FROM SYS.TABLES WHERE NAME = 'nonpart_dedup_copy_table'")
+    assert cursor.fetchone()[0] == 0
+
+
+def test_compressed_payloads(connection):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    meta = [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(5)')]
+
+    service.insert('NONPART_ENVELOPE_TABLE', pack([{'ID': 1, 'VALUE': 'toto'}], 'json'), meta)
+
+    records = [{'ID': i, 'VALUE': 'v{}'.format(i)} for i in range(2, 1000)]
+    service.bulk_insert('NONPART_ENVELOPE_TABLE', pack(records), meta, chunk_size=100)
+
+    lines = ['{}|c{}'.format(i, i) for i in range(1000, 1500)]
+    service.bulk_insert('NONPART_ENVELOPE_TABLE', pack(lines, 'copy'), meta, adaptive=False)
+
+    lines = ['{}|s{}'.format(i, i) for i in range(1500, 1600)]
+    service.bulk_insert('NONPART_ENVELOPE_TABLE', dumps(pack(lines, 'copy')), meta)
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM NONPART_ENVELOPE_TABLE')
+    assert cursor.fetchone()[0] == 1600
+
+    with pytest.raises(ValueError):
+        service.bulk_insert('NONPART_ENVELOPE_TABLE', pack(lines, 'copy'), meta, dedup_key='ID')
+
+
+def test_bulk_load_file(connection, tmpdir):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    meta = [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(5)')]
+    path = tmpdir.join('records.csv')
+    path.write('ID;VALUE\n' + '\n'.join('{};v{}'.format(i, i) for i in range(100)) + '\n')
+
+    service.bulk_load_file('NONPART_FILE_TABLE', str(path), meta, delimiter=';', header=True, on_server=False,
+                           chunk_bytes=64)
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM NONPART_FILE_TABLE')
+    assert cursor.fetchone()[0] == 100
+
+    cursor.execute('DELETE FROM NONPART_FILE_TABLE')
+    service.bulk_load_file('NONPART_FILE_TABLE', str(path), delimiter=';', header=True, offset=10, limit=20,
+                           on_server=False)
+
+    cursor.execute('SELECT MIN(ID), COUNT(*) FROM NONPART_FILE_TABLE')
+    assert cursor.fetchone() == (10, 20)
+
+    cursor.execute('DELETE FROM NONPART_FILE_TABLE')
+    path.write('ID;VALUE\n1;"a\nb"\n2;"c;d"\n\n3;e\n\n\n')
+    service.bulk_load_file('NONPART_FILE_TABLE', str(path), delimiter=';', header=True, on_server=False,
+                           chunk_bytes=4)
+
+    cursor.execute('SELECT ID, VALUE FROM NONPART_FILE_TABLE ORDER BY ID')
+    assert cursor.fetchall() == [(1, 'a\nb'), (2, 'c;d'), (3, 'e')]
+
+
 def test_create_or_replace_view(connection):
     service = worker_factory(DatastoreService, connection=connection)
     service.create_or_replace_view('MYVIEW', 'SELECT 1 AS V', None)
@@ -186,7 +334,27 @@ def test_create_or_replace_view(connection):
 
     assert cursor.fetchone()[0] == 1
 
-    service.create_or_replace_view('MYVIEW', 'SELECT 1 AS V', None)
+    assert service.create_or_replace_view('MYVIEW', 'SELECT 1 AS V', None) is False
+
+    assert service.create_or_replace_view('MYVIEW', 'SELECT %s AS V', [2]) is True
+
+    cursor.execute('SELECT * FROM MYVIEW')
+
+    assert cursor.fetchone()[0] == 2
+
+
+def test_create_or_replace_view_schema(connection):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    connection.execute('CREATE SCHEMA OTHER_VIEW_SCHEMA')
+    try:
+        connection.execute('CREATE VIEW OTHER_VIEW_SCHEMA.MYSCHEMAVIEW AS SELECT 1 AS V')
+
+        assert service.create_or_replace_view('MYSCHEMAVIEW', 'SELECT 1 AS V', None) is True
+        assert service.create_or_replace_view('OTHER_VIEW_SCHEMA.MYSCHEMAVIEW', 'SELECT 1 AS V', None) is False
+    finally:
+        connection.execute('DROP VIEW MYSCHEMAVIEW')
+        connection.execute('DROP SCHEMA OTHER_VIEW_SCHEMA CASCADE')
 
 
 def test_insert_from_select(connection):
@@ -246,12 +414,50 @@ def test_create_or_replace_python_function(connection):
 
     assert cursor.fetchone()[0] == 4
 
-    service.create_or_replace_python_function('python_times_two', script)
+    assert service.create_or_replace_python_function('python_times_two', script) is False
+
+    script = '''
+    CREATE FUNCTION python_times_two(i INTEGER) RETURNS INTEGER LANGUAGE PYTHON {
+        X = i
+        return X * 2
+    };
+    '''
+
+    assert service.create_or_replace_python_function('python_times_two', script) is True
+
+    assert service.create_or_replace_python_function('python_times_two', script.replace('X', 'x')) is True
+
+    assert service.create_or_replace_python_function('python_times_two', script.replace('X', 'x')) is False
 
     cursor.execute('SELECT python_times_two(2) as result')
 
     assert cursor.fetchone()[0] == 4
 
+
+def test_create_or_replace_python_function_schema(connection):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    script = '''
+    CREATE FUNCTION python_schema_times_two(i INTEGER) RETURNS INTEGER LANGUAGE PYTHON {
+        return i * 2
+    };
+    '''
+
+    connection.execute('CREATE SCHEMA OTHER_FUNCTION_SCHEMA')
+    try:
+        connection.execute(script.replace('python_schema_times_two', 'OTHER_FUNCTION_SCHEMA.python_schema_times_two'))
+
+        assert service.get_function_type('python_schema_times_two') is None
+        assert service.create_or_replace_python_function('python_schema_times_two', script) is True
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT python_schema_times_two(2) as result')
+
+        assert cursor.fetchone()[0] == 4
+    finally:
+        connection.execute('DROP SCHEMA OTHER_FUNCTION_SCHEMA CASCADE')
+
+
 def test_create_or_replace_aggregate(connection):
     service = worker_factory(DatastoreService, connection=connection)
 
@@ -275,6 +481,93 @@ def test_create_or_replace_aggregate(connection):
     service.create_or_replace_python_function('python_aggregate', script)
 
 
+def test_apply_definitions(connection):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    script = '''
+    CREATE FUNCTION python_plus_one(i INTEGER) RETURNS INTEGER LANGUAGE PYTHON {
+        return i + 1
+    };
+    '''
+
+    definitions = [
+        {'kind': 'view', 'name': 'MYDEPVIEW', 'query': 'SELECT python_plus_one(V) AS V FROM MYBASEVIEW',
+         'depends_on': ['MYBASEVIEW', 'python_plus_one']},
+        {'kind': 'view', 'name': 'MYBASEVIEW', 'query': 'SELECT 1 AS V'},
+        {'kind': 'function', 'name': 'python_plus_one', 'script': script}
+    ]
+
+    applied = service.apply_definitions(definitions)
+
+    assert sorted(applied) == ['MYBASEVIEW', 'MYDEPVIEW', 'python_plus_one']
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT V FROM MYDEPVIEW')
+
+    assert cursor.fetchone()[0] == 2
+
+    assert service.apply_definitions(definitions) == []
+
+    definitions[1]['query'] = 'SELECT 2 AS V'
+
+    assert service.apply_definitions(definitions) == ['MYBASEVIEW', 'MYDEPVIEW']
+
+    cursor.execute('SELECT V FROM MYDEPVIEW')
+
+    assert cursor.fetchone()[0] == 3
+
+
+def test_deploy_python_udf(connection):
+    service = worker_factory(DatastoreService, connection=connection)
+
+    connection.execute('CREATE TABLE UDF_SAMPLE (GROUP_ID INTEGER, VAL DOUBLE)')
+    connection.execute('INSERT INTO UDF_SAMPLE VALUES (0, 1.0), (0, 2.0), (1, 5.0)')
+
+    result = service.deploy_python_udf('python_grouped_sum', [('val', 'DOUBLE')], 'DOUBLE', template='grouped_sum',
+                                       benchmark_table='UDF_SAMPLE', benchmark_columns=['VAL'], benchmark_runs=2,
+                                       benchmark_group='GROUP_ID')
+
+    assert result['changed'] is True
+    assert len(result['benchmark']['timings']) == 2
+    assert len(result['benchmark']['grouped']['timings']) == 2
+
+    result = service.deploy_python_udf('python_grouped_sum', [('val', 'DOUBLE')], 'DOUBLE', template='grouped_sum',
+                                       benchmark_table='UDF_SAMPLE', benchmark_columns=['VAL'], benchmark_runs='1')
+
+    assert result['changed'] is False
+    assert len(result['benchmark']['grouped']['timings']) == 1
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT GROUP_ID, python_grouped_sum(VAL) FROM UDF_SAMPLE GROUP BY GROUP_ID ORDER BY GROUP_ID')
+
+    assert cursor.fetchall() == [(0, 3.0), (1, 5.0)]
+
+    result = service.deploy_python_udf('python_scale', [('val', 'DOUBLE')], 'DOUBLE', body='return val * 3',
+                                       benchmark_table='UDF_SAMPLE', benchmark_columns=['VAL'], max_duration=0)
+
+    assert result['benchmark']['slow'] is True
+
+    cursor.execute('SELECT python_scale(VAL) FROM UDF_SAMPLE WHERE GROUP_ID = 1')
+
+    assert cursor.fetchone()[0] == 15.0
+
+    with pytest.raises(ValueError):
+        service.deploy_python_udf('python_scale', [('val', 'DOUBLE')], 'DOUBLE')
+
+    with pytest.raises(ValueError):
+        service.deploy_python_udf('python_clip', [('val', 'DOUBLE')], 'DOUBLE', template='clip',
+                                  template_params={'low': 0})
+
+    with pytest.raises(ValueError):
+        service.deploy_python_udf('python_clip', [('val', 'DOUBLE')], 'DOUBLE', template='clip',
+                                  template_params={'low': 0, 'high': 1}, benchmark_table='UDF_SAMPLE',
+                                  benchmark_runs=0)
+
+    cursor.execute("SELECT COUNT(*) FROM SYS.FUNCTIONS WHERE NAME = 'python_clip'")
+
+    assert cursor.fetchone()[0] == 0
+
+
 def test_add_partition(connection):
     service = worker_factory(DatastoreService, connection=connection)
 
@@ -308,3 +601,115 @@ def test_drop_paritition(connection):
     cursor.execute('SELECT ID FROM MT2')
 
     assert cursor.fetchone()[0] == 2
+
+
+def test_get_slow_statements(connection):
+    container = Mock(config={'SLOW_STATEMENT_THRESHOLD': 0})
+    profiler = StatementProfiler().bind(container, 'profiler')
+    profiler.setup()
+    service = worker_factory(DatastoreService, connection=connection, profiler=profiler)
+
+    records = [{'ID': 1, 'VALUE': 'toto'}, {'ID': 2, 'VALUE': 'titi'}]
+    meta = [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(5)')]
+
+    service.bulk_insert('NONPART_PROFILED_BULK_TABLE', records, meta)
+
+    statements = service.get_slow_statements()
+
+    assert statements[-1]['shape'] == 'COPY ? RECORDS INTO NONPART_PROFILED_BULK_TABLE FROM STDIN NULL AS ?'
+    assert statements[-1]['rows'] == 2
+
+    with pytest.raises(pymonetdb.exceptions.OperationalError):
+        service.bulk_insert('NONPART_PROFILED_BULK_TABLE', [{'ID': 'wrong', 'VALUE': 'titi'}], meta)
+
+    statements = service.get_slow_statements()
+
+    assert statements[-1]['shape'].startswith('COPY ? RECORDS INTO NONPART_PROFILED_BULK_TABLE')
+    assert statements[-1]['error'] is not None
+
+
+def test_bulk_insert_fake_mapi(fake_mapi):
+    fake_connection = pymonetdb.connect(username='monetdb', password='monetdb', hostname=fake_mapi.host,
+                                        port=fake_mapi.port, database='fake', autocommit=True)
+    service = worker_factory(DatastoreService, connection=fake_connection)
+
+    records = [{'ID': i, 'VALUE': 'v{}'.format(i)} for i in range(1000)]
+    meta = [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(5)')]
+
+    service.bulk_insert('FAKE_BULK_TABLE', records, meta, chunk_size=300)
+
+    assert fake_mapi.stats['copies'] == 4
+    assert fake_mapi.stats['copied_records'] == 1000
+    assert fake_mapi.statements[-1] == 'COPY 100 RECORDS INTO FAKE_BULK_TABLE FROM STDIN NULL AS \'\''
+
+    fake_connection.close()
+
+
+def test_bulk_load_file_fake_mapi(fake_mapi, tmpdir):
+    fake_connection = pymonetdb.connect(username='monetdb', password='monetdb', hostname=fake_mapi.host,
+                                        port=fake_mapi.port, database='fake', autocommit=True)
+    service = worker_factory(DatastoreService, connection=fake_connection)
+
+    path = tmpdir.join('records.csv')
+    path.write('ID;VALUE\n1;"a\nb"\n\n2;c\n\n')
+    options = 'USING DELIMITERS \';\', \'\\n\', \'"\' NULL AS \'\''
+
+    service.bulk_load_file('FAKE_FILE_TABLE', str(path), delimiter=';', header=True)
+    service.bulk_load_file('FAKE_FILE_TABLE', str(path), delimiter=';', header=True, offset=10, limit=20)
+    service.bulk_load_file('FAKE_FILE_TABLE', str(path), delimiter=';', limit=5)
+
+    assert fake_mapi.statements[-3:] == [
+        'COPY OFFSET 2 INTO FAKE_FILE_TABLE FROM \'{}\' {}'.format(path, options),
+        'COPY 20 OFFSET 12 RECORDS INTO FAKE_FILE_TABLE FROM \'{}\' {}'.format(path, options),
+        'COPY 5 RECORDS INTO FAKE_FILE_TABLE FROM \'{}\' {}'.format(path, options)
+    ]
+
+    service.bulk_load_file('FAKE_FILE_TABLE', str(path), delimiter=';', header=True, on_server=False)
+
+    assert fake_mapi.statements[-1] == 'COPY 2 RECORDS INTO FAKE_FILE_TABLE FROM STDIN {}'.format(options)
+    assert fake_mapi.stats['copied_records'] == 2
+
+    fake_connection.close()
+
+
+def test_bulk_insert_adaptive_fake_mapi(fake_mapi):
+    fake_mapi.latency = 0.005
+    fake_mapi.copy_latency = 0.00001
+    fake_connection = pymonetdb.connect(username='monetdb', password='monetdb', hostname=fake_mapi.host,
+                                        port=fake_mapi.port, database='fake', autocommit=True)
+
+    def copies(table):
+        return [int(s.split()[1]) for s in fake_mapi.statements if s.startswith('COPY') and ' {} '.format(table) in s]
+
+    container = Mock(config={'COPY_CHUNK_INITIAL_BYTES': 256 * 1024, 'COPY_CHUNK_TARGET_LATENCY': 0.2})
+    chunk_sizer = AdaptiveChunkSize().bind(container, 'chunk_sizer')
+    chunk_sizer.setup()
+    service = worker_factory(DatastoreService, connection=fake_connection, chunk_sizer=chunk_sizer)
+
+    narrow = [{'ID': i} for i in range(30000)]
+    wide = [{'ID': i, 'VALUE': 'v' * 200} for i in range(20000)]
+
+    service.bulk_insert('FAKE_NARROW_STATIC', narrow, [('ID', 'INTEGER')])
+    service.bulk_insert('FAKE_NARROW_ADAPTIVE', narrow, [('ID', 'INTEGER')], adaptive=True)
+    service.bulk_insert('FAKE_WIDE_STATIC', wide, [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(200)')])
+    service.bulk_insert('FAKE_WIDE_ADAPTIVE', wide, [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(200)')], adaptive=True)
+
+    assert sum(copies('FAKE_NARROW_ADAPTIVE')) == sum(copies('FAKE_WIDE_ADAPTIVE')) + 10000
+    assert len(copies('FAKE_NARROW_ADAPTIVE')) < len(copies('FAKE_NARROW_STATIC'))
+    assert len(copies('FAKE_WIDE_ADAPTIVE')) < len(copies('FAKE_WIDE_STATIC'))
+
+    assert copies('FAKE_NARROW_ADAPTIVE')[0] > 10 * copies('FAKE_WIDE_ADAPTIVE')[0]
+    assert copies('FAKE_WIDE_ADAPTIVE')[1] > copies('FAKE_WIDE_ADAPTIVE')[0]
+    assert chunk_sizer.get_target_bytes('FAKE_WIDE_ADAPTIVE') > 256 * 1024
+
+    container = Mock(config={'COPY_CHUNK_INITIAL_BYTES': 256 * 1024, 'COPY_CHUNK_TARGET_LATENCY': 0.001})
+    chunk_sizer = AdaptiveChunkSize().bind(container, 'chunk_sizer')
+    chunk_sizer.setup()
+    service = worker_factory(DatastoreService, connection=fake_connection, chunk_sizer=chunk_sizer)
+
+    service.bulk_insert('FAKE_WIDE_SLOW', wide[:5000], [('ID', 'INTEGER'), ('VALUE', 'VARCHAR(200)')], adaptive=True)
+
+    assert copies('FAKE_WIDE_SLOW')[1] < copies('FAKE_WIDE_SLOW')[0]
+    assert chunk_sizer.get_target_bytes('FAKE_WIDE_SLOW') < 256 * 1024
+
+    fake_connection.close()